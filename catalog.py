@@ -49,7 +49,7 @@ SCRIPT_MAP: Dict[str, List[str]] = {
 def detect(frame: numpy.ndarray) -> bool:
     """Detects if a given frame is showing Nook Shopping catalog."""
     side_color = frame[140:150, -20:].mean(axis=(0, 1))
-    return numpy.linalg.norm(side_color - BG_COLOR) < 6
+    return sum((c - b) ** 2 for c, b in zip(side_color, BG_COLOR)) < 36
 
 
 def scan(video_file: str, locale: str = 'en-us', for_sale: bool = False) -> ScanResult:
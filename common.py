@@ -1,7 +1,19 @@
 import dataclasses
 import enum
+import functools
+import json
+import queue
+import threading
 
-from typing import List
+import cv2
+import numpy
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optional; the stdlib json parser is used instead.
+
+from typing import Dict, Iterator, List, Optional
 
 
 class ScanMode(enum.Enum):
@@ -18,3 +30,81 @@ class ScanResult:
     mode: ScanMode
     items: List[str]
     locale: str
+
+
+def _init_opencl() -> bool:
+    """Enables OpenCV's OpenCL dispatch when a usable device is present."""
+    try:
+        if cv2.ocl.haveOpenCL():
+            cv2.ocl.setUseOpenCL(True)
+            return cv2.ocl.useOpenCL()
+    except cv2.error:
+        pass
+    return False
+
+
+# Whether cv2 operations on UMat inputs will dispatch to OpenCL.
+HAVE_OPENCL = _init_opencl()
+
+
+@functools.lru_cache(maxsize=None)
+def load_translations(path: str) -> Dict[str, Dict[str, str]]:
+    """Loads a translations file, cached per path for batch usage."""
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_frames(filename: str, step: int = 1) -> Iterator[numpy.ndarray]:
+    """Decodes video frames on a worker thread, overlapping with processing.
+
+    The worker thread only demuxes and decodes; all frame filtering and
+    cropping stays on the consumer side. When step > 1, only every step-th
+    frame is fully decoded and the frames in between are skipped.
+    """
+    frames: 'queue.Queue' = queue.Queue(maxsize=8)
+    stopped = threading.Event()
+
+    def produce():
+        cap = cv2.VideoCapture(filename)
+        try:
+            while not stopped.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break  # Video is over
+                _queue_put(frames, frame, stopped)
+
+                # Skip in-between frames with grab(), which demuxes but
+                # avoids the expensive pixel conversion done by read().
+                skipped = 0
+                while skipped < step - 1 and cap.grab():
+                    skipped += 1
+                if skipped < step - 1:
+                    break  # Video is over
+        finally:
+            cap.release()
+            _queue_put(frames, None, stopped)  # Signal the end of the video.
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                break  # Video is over
+            yield frame
+    finally:
+        stopped.set()
+
+
+def _queue_put(frames: 'queue.Queue', frame: Optional[numpy.ndarray],
+               stopped: threading.Event) -> None:
+    """Puts a frame on the queue, giving up once the consumer has stopped."""
+    while not stopped.is_set():
+        try:
+            frames.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            continue
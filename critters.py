@@ -1,5 +1,5 @@
 import itertools
-from common import ScanMode, ScanResult
+from common import ScanMode, ScanResult, load_translations
 
 import collections
 import cv2
@@ -47,7 +47,7 @@ class CritterIcon(numpy.ndarray):
 def detect(frame: numpy.ndarray) -> bool:
     """Detects if a given frame is showing Critterpedia."""
     color = frame[:20, 1100:1150].mean(axis=(0, 1))
-    return numpy.linalg.norm(color - BG_COLOR) < 5
+    return sum((c - b) ** 2 for c, b in zip(color, BG_COLOR)) < 25
 
 
 def scan(video_file: str, locale: str = 'en-us') -> ScanResult:
@@ -97,9 +97,7 @@ def translate_names(critter_names: List[str], locale: str) -> List[str]:
     if locale in ['auto', 'en-us']:
         return critter_names
 
-    translation_path = os.path.join('critters', 'translations.json')
-    with open(translation_path, encoding='utf-8') as fp:
-        translations = json.load(fp)
+    translations = load_translations(os.path.join('critters', 'translations.json'))
     return [translations[name][locale] for name in critter_names]
 
 
@@ -129,7 +127,7 @@ def _read_frames(filename: str) -> Iterator[Tuple[CritterType, numpy.ndarray]]:
 
         # Detect a dark line that shows up only in Pictures Mode.
         mode_detector = frame[20:24, 600:800].mean(axis=(0, 1))
-        if numpy.linalg.norm(mode_detector - (199, 234, 237)) > 50:
+        if sum((c - b) ** 2 for c, b in zip(mode_detector, (199, 234, 237))) > 2500:
             raise AssertionError('Critterpedia is in Pictures Mode.')
 
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
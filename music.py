@@ -1,5 +1,4 @@
-from common import ScanMode, ScanResult
-from PIL import Image
+from common import HAVE_OPENCL, ScanMode, ScanResult, decode_frames, load_translations
 
 import cv2
 import functools
@@ -7,19 +6,30 @@ import imagehash
 import json
 import numpy
 import os
+import scipy.fft
 
-from typing import Iterator, List
+try:
+    import numba
+except ImportError:
+    numba = None  # Optional; pure NumPy fallbacks are used instead.
+
+from typing import Iterator, List, Optional, Tuple
 
 # The expected color for the video background.
 BG_COLOR = (238, 217, 101)
 
+# Lookup table mapping a byte to the number of bits set in it,
+# used to compute Hamming distances on packed hashes.
+POPCOUNT_LUT = numpy.array(
+    [bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
 
 class SongCover:
-    """The image and data associated with a given song."""
+    """Debug-friendly view of a single song database entry."""
 
     def __init__(self, song_name: str, hash_hex: str):
         self.song_name = song_name
-        self.icon_hash = imagehash.hex_to_hash(hash_hex)
+        self.hash_hex = hash_hex
 
     def __repr__(self):
         return f'SongCover({self.song_name!r}, {self.hash_hex!r})'
@@ -27,8 +37,13 @@ class SongCover:
 
 def detect(frame: numpy.ndarray) -> bool:
     """Detects if a given frame is showing the music list."""
-    color = frame[:20, 1220:1250].mean(axis=(0, 1))
-    return numpy.linalg.norm(color - BG_COLOR) < 10
+    roi = frame[:20, 1220:1250]
+    # Cheap single-pixel screen; rejects most non-matching frames early.
+    pixel = roi[0, 0]
+    if sum(abs(int(p) - c) for p, c in zip(pixel, BG_COLOR)) > 40:
+        return False
+    mean = cv2.mean(roi)[:3]
+    return sum((m - c) ** 2 for m, c in zip(mean, BG_COLOR)) < 100
 
 
 def scan(video_file: str, locale: str = 'en-us') -> ScanResult:
@@ -47,24 +62,25 @@ def scan(video_file: str, locale: str = 'en-us') -> ScanResult:
 def parse_video(filename: str) -> List[numpy.ndarray]:
     """Parses a whole video and returns images for all song covers found."""
     all_covers: List[numpy.ndarray] = []
+    row_hashes: List[int] = []
     for i, frame in enumerate(_read_frames(filename)):
         for new_covers in _parse_frame(frame):
-            if _is_duplicate_cards(all_covers, new_covers):
+            new_hash = _row_hash(new_covers)
+            if _is_duplicate_cards(all_covers, row_hashes, new_covers, new_hash):
                 continue  # Skip non-moving frames
             all_covers.extend(new_covers)
+            row_hashes.append(new_hash)
     return _remove_blanks(all_covers)
 
 
 def match_songs(song_covers: List[numpy.ndarray]) -> List[str]:
     """Matches icons against database of music covers, finding best matches."""
-    matched_songs = set()
-    song_db = _get_song_db()
-    for cover in song_covers:
-        image = Image.fromarray(cover)
-        test_hash = imagehash.phash(image, hash_size=18)
-        best_match = min(song_db, key=lambda x: x.icon_hash - test_hash)
-        matched_songs.add(best_match.song_name)
-    return list(matched_songs)
+    if not song_covers:
+        return []
+
+    song_names, hash_matrix = _get_song_db()
+    matches = _match_all(_batch_phash(song_covers), hash_matrix)
+    return list({song_names[i] for i in matches})
 
 
 def translate_names(song_names: List[str], locale: str) -> List[str]:
@@ -72,20 +88,13 @@ def translate_names(song_names: List[str], locale: str) -> List[str]:
     if locale in ['auto', 'en-us']:
         return song_names
 
-    translation_path = os.path.join('music', 'translations.json')
-    with open(translation_path, encoding='utf-8') as fp:
-        translations = json.load(fp)
+    translations = load_translations(os.path.join('music', 'translations.json'))
     return [translations[name][locale] for name in song_names]
 
 
 def _read_frames(filename: str) -> Iterator[numpy.ndarray]:
     """Parses frames of the given video and returns the relevant region."""
-    cap = cv2.VideoCapture(filename)
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
+    for frame in decode_frames(filename):
         assert frame.shape[:2] == (720, 1280), \
             'Invalid resolution: {1}x{0}'.format(*frame.shape)
 
@@ -95,21 +104,33 @@ def _read_frames(filename: str) -> Iterator[numpy.ndarray]:
         # Crop the region containing only song covers.
         yield frame[95:670, 40:1240]
 
-    cap.release()
-
 
 def _parse_frame(frame: numpy.ndarray) -> Iterator[List[numpy.ndarray]]:
     """Parses an individual frame and extracts song covers from the music list."""
     # Start vertical position for the 4 song covers.
     x_positions = [40, 327, 614, 900]
 
-    # This code finds areas of the image that are sky blue (background color),
-    # then it averages the frame across the Y-axis to find the area rows.
-    # Lastly, it finds the y-positions marking the start/end of each row.
+    # Find areas of the image that are sky blue (background color),
+    # then derive the y-positions of the cover rows from the mask.
     thresh = cv2.inRange(frame[:410], (210, 200, 75), (255, 235, 125))
-    separators = numpy.diff(thresh.mean(axis=1) > 100).nonzero()[0]
+    for y in _find_y_positions(thresh):
+        if y + 260 > frame.shape[0]:
+            continue  # Past the bottom of the frame
+        yield [frame[y:y+260, x:x+260] for x in x_positions]
+
+
+def _find_y_positions(thresh: numpy.ndarray) -> numpy.ndarray:
+    """Finds the y-positions marking the start of each cover row.
+
+    This averages the background mask across the Y-axis to find the area
+    rows, then derives the row grid from the start/end transitions.
+    """
+    # Integer row sums in C; same as mean(axis=1) > 100 without the
+    # intermediate float array.
+    row_sums = cv2.reduce(thresh, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    separators = numpy.diff(row_sums > 100 * thresh.shape[1]).nonzero()[0]
     if len(separators) < 2:
-        return
+        return numpy.empty(0, numpy.int32)
 
     # We do a first pass finding all sensible y positions.
     y_centers = []
@@ -118,48 +139,208 @@ def _parse_frame(frame: numpy.ndarray) -> Iterator[List[numpy.ndarray]]:
             y_centers.extend([y1 % 287, (y2 + 25) % 287])
         if 20 < y2 - y1 < 27:
             y_centers.extend([y2 % 287, (y1 + 25) % 287])
+    if not y_centers:
+        return numpy.empty(0, numpy.int32)
     y_centroid = numpy.mean(y_centers) + 1
-    y_positions = numpy.arange(y_centroid, 575, 287).astype(int)
-
-    for y in y_positions:
-        if y + 260 > frame.shape[0]:
-            continue  # Past the bottom of the frame
-        yield [frame[y:y+260, x:x+260] for x in x_positions]
-
-
-def _is_duplicate_cards(all_covers: List[numpy.ndarray], new_covers: List[numpy.ndarray]) -> bool:
+    return numpy.arange(y_centroid, 575, 287).astype(numpy.int32)
+
+
+if numba is not None:
+    # Fused version of the above: one typed pass over the mask with no
+    # intermediate arrays. Compiled once and cached on disk.
+    @numba.njit(cache=True)
+    def _find_y_positions(thresh: numpy.ndarray) -> numpy.ndarray:  # noqa: F811
+        height, width = thresh.shape
+        separators = numpy.empty(height, numpy.int32)
+        count = 0
+        prev_hot = False
+        for y in range(height):
+            total = 0
+            for x in range(width):
+                total += thresh[y, x]
+            hot = total > 100 * width  # Same as mean(axis=1) > 100.
+            if y > 0 and hot != prev_hot:
+                separators[count] = y - 1
+                count += 1
+            prev_hot = hot
+        if count < 2:
+            return numpy.empty(0, numpy.int32)
+
+        center_sum = 0.0
+        center_count = 0
+        for i in range(count - 1):
+            y1, y2 = separators[i], separators[i + 1]
+            if 259 < y2 - y1 < 266:
+                center_sum += y1 % 287 + (y2 + 25) % 287
+                center_count += 2
+            if 20 < y2 - y1 < 27:
+                center_sum += y2 % 287 + (y1 + 25) % 287
+                center_count += 2
+        if not center_count:
+            return numpy.empty(0, numpy.int32)
+
+        y_positions = numpy.empty(4, numpy.int32)
+        y_center = center_sum / center_count + 1
+        count = 0
+        while y_center < 575:
+            y_positions[count] = int(y_center)
+            count += 1
+            y_center += 287
+        return y_positions[:count]
+
+    # Warm the compilation cache so the first frame isn't penalized.
+    _find_y_positions(numpy.zeros((2, 2), numpy.uint8))
+
+
+# Reusable row buffers for the duplicate checks below, so the per-frame
+# dedup path doesn't allocate fresh row-sized arrays on every call.
+_NEW_ROW_BUF: Optional[numpy.ndarray] = None
+_OLD_ROW_BUF: Optional[numpy.ndarray] = None
+
+
+def _hconcat_into(imgs: List[numpy.ndarray],
+                  buf: Optional[numpy.ndarray]) -> numpy.ndarray:
+    """Concatenates images horizontally into a reusable buffer."""
+    height, width = imgs[0].shape[:2]
+    shape = (height, width * len(imgs), 3)
+    if buf is None or buf.shape != shape:
+        buf = numpy.empty(shape, numpy.uint8)
+    for i, img in enumerate(imgs):
+        buf[:, i * width:(i + 1) * width] = img
+    return buf
+
+
+def _row_hash(row_imgs: List[numpy.ndarray]) -> int:
+    """Computes a 64-bit difference hash for a row of card images."""
+    global _NEW_ROW_BUF
+    _NEW_ROW_BUF = _hconcat_into(row_imgs, _NEW_ROW_BUF)
+    tiny = cv2.resize(_NEW_ROW_BUF, (9, 8))
+    gray = cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY)
+    bits = (gray[:, 1:] > gray[:, :-1]).astype(numpy.uint8)
+    return int(numpy.packbits(bits).view(numpy.uint64)[0])
+
+
+def _is_duplicate_cards(all_covers: List[numpy.ndarray], row_hashes: List[int],
+                        new_covers: List[numpy.ndarray], new_hash: int) -> bool:
     """Checks if the new set of covers are the same as the previous seen covers."""
+    global _NEW_ROW_BUF, _OLD_ROW_BUF
     if not all_covers or len(all_covers) < len(new_covers):
         return False
 
-    new_concat = cv2.hconcat(new_covers)
     # Checks the last 2 rows for similarities to the newly added row.
-    for ind in [slice(-4, None), slice(-8, -4)]:
-        old_concat = cv2.hconcat(all_covers[ind])
-        if old_concat is None:
+    for offset, ind in [(-1, slice(-4, None)), (-2, slice(-8, -4))]:
+        if len(row_hashes) < -offset:
             continue
-        if cv2.absdiff(new_concat, old_concat).mean() < 15:
+        distance = bin(new_hash ^ row_hashes[offset]).count('1')
+        if distance < 10:
+            return True  # Hashes agree; clearly the same row.
+        if distance >= 20:
+            continue  # Hashes clearly differ; skip the image comparison.
+
+        # Marginal hash distance; fall back to the full image comparison.
+        _NEW_ROW_BUF = _hconcat_into(new_covers, _NEW_ROW_BUF)
+        _OLD_ROW_BUF = _hconcat_into(all_covers[ind], _OLD_ROW_BUF)
+        if _mean_absdiff(_NEW_ROW_BUF, _OLD_ROW_BUF) < 15:
             return True
     return False
 
 
+def _mean_absdiff(img1: numpy.ndarray, img2: numpy.ndarray) -> float:
+    """Computes the mean absolute difference, on the GPU when available."""
+    if HAVE_OPENCL:
+        # Only per-channel scalars come back from the device.
+        diff = cv2.absdiff(cv2.UMat(img1), cv2.UMat(img2))
+        return sum(cv2.mean(diff)[:3]) / 3
+    return cv2.absdiff(img1, img2).mean()
+
+
 def _remove_blanks(all_icons: List[numpy.ndarray]) -> List[numpy.ndarray]:
     """Remove all icons that do not show a song cover."""
-    filtered_icons = []
-    for icon in all_icons:
-        color = icon[5:25, 60:200].mean(axis=(0, 1))
-        if numpy.linalg.norm(color - BG_COLOR) < 5:
-            continue
-        filtered_icons.append(icon)
-    return filtered_icons
+    if not all_icons:
+        return []
+
+    # Compute the background-region color of all icons in one pass.
+    regions = numpy.stack([icon[5:25, 60:200] for icon in all_icons])
+    colors = regions.reshape(len(all_icons), -1, 3).mean(axis=1)
+    distances = ((colors - BG_COLOR) ** 2).sum(axis=1)
+    return [icon for icon, distance in zip(all_icons, distances)
+            if distance >= 25]
+
+
+def _batch_phash(covers: List[numpy.ndarray], hash_size: int = 18,
+                 highfreq_factor: int = 4) -> numpy.ndarray:
+    """Computes packed perceptual hashes for all covers in one batched DCT."""
+    size = hash_size * highfreq_factor
+    # RGB2GRAY on BGR covers keeps the channel weights of the old PIL
+    # round-trip, which the database hashes were generated with.
+    gray = numpy.stack([
+        cv2.resize(cv2.cvtColor(cover, cv2.COLOR_RGB2GRAY), (size, size),
+                   interpolation=cv2.INTER_AREA)
+        for cover in covers]).astype(numpy.float32)
+
+    # Single multi-threaded DCT over the whole stack, then threshold the
+    # low-frequency corner against each cover's median.
+    dct = scipy.fft.dct(
+        scipy.fft.dct(gray, axis=1, workers=-1), axis=2, workers=-1)
+    low_freq = dct[:, :hash_size, :hash_size].reshape(len(covers), -1)
+    medians = numpy.median(low_freq, axis=1, keepdims=True)
+    return numpy.packbits(low_freq > medians, axis=1)
+
+
+def _match_all(queries: numpy.ndarray, hashes: numpy.ndarray) -> numpy.ndarray:
+    """Finds the database row with the smallest Hamming distance per query.
+
+    Queries are processed in blocks so the XOR tile against the whole
+    database stays cache-resident instead of materializing the full
+    (Q, M) distance tensor at once.
+    """
+    best = numpy.empty(len(queries), numpy.int64)
+    for start in range(0, len(queries), 64):
+        block = queries[start:start + 64]
+        xor = numpy.bitwise_xor(block[:, None, :], hashes[None, :, :])
+        distances = POPCOUNT_LUT[xor].sum(axis=2, dtype=numpy.int32)
+        best[start:start + 64] = distances.argmin(axis=1)
+    return best
+
+
+if numba is not None:
+    # Fused version of the above: XOR, popcount and the min reduction in
+    # one parallel typed loop with no intermediate arrays.
+    @numba.njit(parallel=True, cache=True)
+    def _match_all(queries: numpy.ndarray, hashes: numpy.ndarray) -> numpy.ndarray:  # noqa: F811
+        best = numpy.empty(queries.shape[0], numpy.int64)
+        for i in numba.prange(queries.shape[0]):
+            best_distance = 1 << 30
+            best_index = 0
+            for m in range(hashes.shape[0]):
+                distance = 0
+                for j in range(hashes.shape[1]):
+                    distance += POPCOUNT_LUT[hashes[m, j] ^ queries[i, j]]
+                if distance < best_distance:
+                    best_distance = distance
+                    best_index = m
+            best[i] = best_index
+        return best
+
+    # Warm the compilation cache so the first query isn't penalized.
+    _match_all(numpy.zeros((1, 1), numpy.uint8),
+               numpy.zeros((1, 1), numpy.uint8))
 
 
 @functools.lru_cache()
-def _get_song_db() -> List[SongCover]:
-    """Fetches the song cover database for a given locale, with caching."""
+def _get_song_db() -> Tuple[List[str], numpy.ndarray]:
+    """Fetches the song names and their packed cover hashes, with caching.
+
+    Hashes are laid out struct-of-arrays style: one contiguous (M, 41)
+    uint8 matrix, with the name list indexed in parallel.
+    """
     with open(os.path.join('music', 'names.json')) as fp:
         music_data = json.load(fp)
-    return [SongCover(name, hash_hex) for name, _, hash_hex in music_data]
+    song_names = [name for name, _, _ in music_data]
+    hashes = numpy.stack([
+        numpy.packbits(imagehash.hex_to_hash(hash_hex).hash.flatten())
+        for _, _, hash_hex in music_data])
+    return song_names, hashes
 
 
 if __name__ == "__main__":
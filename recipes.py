@@ -1,4 +1,4 @@
-from common import ScanMode, ScanResult
+from common import HAVE_OPENCL, ScanMode, ScanResult, decode_frames, load_translations
 
 import collections
 import cv2
@@ -7,7 +7,12 @@ import json
 import numpy
 import os
 
-from typing import Dict, Iterator, List, Tuple
+try:
+    import numba
+except ImportError:
+    numba = None  # Optional; pure NumPy fallbacks are used instead.
+
+from typing import Dict, Iterator, List, Optional, Tuple
 
 # The expected color for the video background.
 BG_COLOR = (194, 223, 228)
@@ -31,13 +36,19 @@ CARD_TYPES: Dict[Tuple[int, int, int], str] = {
     (122, 225, 230): 'yellow',
 }
 
+# The same card type colors as an array, for vectorized distance checks.
+CARD_TYPE_COLORS = numpy.array(list(CARD_TYPES), dtype=numpy.int16)
+CARD_TYPE_NAMES = list(CARD_TYPES.values())
+
 
 class RecipeCard:
     """The image and data associated with a given recipe."""
 
-    def __init__(self, item_name, card_type):
-        img_path = os.path.join('recipes', 'generated', item_name + '.png')
-        self.img = cv2.imread(img_path)
+    def __init__(self, item_name, card_type, img=None):
+        if img is None:
+            img_path = os.path.join('recipes', 'generated', item_name + '.png')
+            img = cv2.imread(img_path)
+        self.img = img
         self.item_name = item_name
         self.card_type = card_type
 
@@ -47,10 +58,17 @@ class RecipeCard:
 
 def detect(frame: numpy.ndarray) -> bool:
     """Detects if a given frame is showing DIY recipes."""
-    color = frame[:20, 1200:1250].mean(axis=(0, 1))
-    if numpy.linalg.norm(color - WOOD_COLOR) < 5:
+    roi = frame[:20, 1200:1250]
+    # Cheap single-pixel screen; rejects most non-matching frames early.
+    pixel = roi[0, 0]
+    near_bg = sum(abs(int(p) - c) for p, c in zip(pixel, BG_COLOR)) <= 40
+    near_wood = sum(abs(int(p) - c) for p, c in zip(pixel, WOOD_COLOR)) <= 40
+    if not near_bg and not near_wood:
+        return False
+    mean = cv2.mean(roi)[:3]
+    if sum((m - c) ** 2 for m, c in zip(mean, WOOD_COLOR)) < 25:
         raise AssertionError('Workbench scanning is not supported.')
-    return numpy.linalg.norm(color - BG_COLOR) < 5
+    return sum((m - c) ** 2 for m, c in zip(mean, BG_COLOR)) < 25
 
 
 def scan(video_file: str, locale: str = 'en-us') -> ScanResult:
@@ -69,23 +87,23 @@ def scan(video_file: str, locale: str = 'en-us') -> ScanResult:
 def parse_video(filename: str) -> List[numpy.ndarray]:
     """Parses a whole video and returns images for all recipe cards found."""
     all_cards: List[numpy.ndarray] = []
-    for i, frame in enumerate(_read_frames(filename)):
-        if i % 4 != 0:
-            continue  # Skip every 4th frame
+    row_hashes: List[int] = []
+    for frame in _read_frames(filename):
         for new_cards in _parse_frame(frame):
-            if _is_duplicate_cards(all_cards, new_cards):
+            new_hash = _row_hash(new_cards)
+            if _is_duplicate_cards(all_cards, row_hashes, new_cards, new_hash):
                 continue  # Skip non-moving frames
-            all_cards.extend(new_cards)
+            all_cards.extend(_normalize_cards(new_cards))
+            row_hashes.append(new_hash)
     return all_cards
 
 
 def match_recipes(recipe_cards: List[numpy.ndarray]) -> List[str]:
     """Matches icons against database of recipe images, finding best matches."""
     matched_recipes = set()
-    recipe_db = _get_recipe_db()
     for card in recipe_cards:
         card_type = _guess_card_type(card)
-        best_match = _find_best_match(card, recipe_db[card_type])
+        best_match = _find_best_match(card, card_type)
         matched_recipes.add(best_match.item_name)
     return list(matched_recipes)
 
@@ -95,20 +113,15 @@ def translate_names(recipe_names: List[str], locale: str) -> List[str]:
     if locale in ['auto', 'en-us']:
         return recipe_names
 
-    translation_path = os.path.join('recipes', 'translations.json')
-    with open(translation_path, encoding='utf-8') as fp:
-        translations = json.load(fp)
+    translations = load_translations(os.path.join('recipes', 'translations.json'))
     return [translations[name][locale] for name in recipe_names]
 
 
 def _read_frames(filename: str) -> Iterator[numpy.ndarray]:
     """Parses frames of the given video and returns the relevant region."""
-    cap = cv2.VideoCapture(filename)
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break  # Video is over
-
+    # Only one frame in four is parsed; skipping at the decoder avoids
+    # fully decoding the others in the first place.
+    for frame in decode_frames(filename, step=4):
         assert frame.shape[:2] == (720, 1280), \
             'Invalid resolution: {1}x{0}'.format(*frame.shape)
 
@@ -117,7 +130,6 @@ def _read_frames(filename: str) -> Iterator[numpy.ndarray]:
 
         # Crop the region containing recipe cards.
         yield frame[110:720, 45:730]
-    cap.release()
 
 
 def _parse_frame(frame: numpy.ndarray) -> Iterator[List[numpy.ndarray]]:
@@ -125,11 +137,31 @@ def _parse_frame(frame: numpy.ndarray) -> Iterator[List[numpy.ndarray]]:
     # Start/end horizontal position for the 5 recipe cards.
     x_positions = [(11, 123), (148, 260), (286, 398), (423, 535), (560, 672)]
 
-    # This code finds areas of the image that are beige (background color),
-    # then it averages the frame across the Y-axis to find the area rows.
-    # Lastly, it finds the y-positions marking the start/end of each row.
+    # Find areas of the image that are beige (background color),
+    # then derive the y-positions of the card rows from the mask.
     thresh = cv2.inRange(frame, (185, 215, 218), (210, 230, 237))
-    separators = numpy.diff(thresh.mean(axis=1) > 190).nonzero()[0]
+    for y1 in _find_y_positions(thresh):
+        row = []
+        for x1, x2 in x_positions:
+            card = frame[y1+37:y1+149, x1:x2]
+            # Detects selected cards, which are bigger; they keep their
+            # larger crop here and are resized once if the row is kept.
+            if y1 > 9 and thresh[y1-10:y1-5, x1:x2].mean() < 100:
+                card = frame[y1+22:y1+152, x1-9:x2+9]
+            row.append(card)
+        yield row
+
+
+def _find_y_positions(thresh: numpy.ndarray) -> numpy.ndarray:
+    """Finds the y-positions marking the start of each card row.
+
+    This averages the background mask across the Y-axis to find the area
+    rows, then keeps the start/end transitions that match the card size.
+    """
+    # Integer row sums in C; same as mean(axis=1) > 190 without the
+    # intermediate float array.
+    row_sums = cv2.reduce(thresh, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+    separators = numpy.diff(row_sums > 190 * thresh.shape[1]).nonzero()[0]
 
     # We do a first pass finding all sensible y positions.
     y_positions = []
@@ -141,45 +173,130 @@ def _parse_frame(frame: numpy.ndarray) -> Iterator[List[numpy.ndarray]]:
     # Then, if the last row is missing, we predict its value.
     if y_positions and y_positions[-1] < 100:
         y_positions.append(y_positions[-1] + 211)
-
-    for y1 in y_positions:
-        row = []
-        for x1, x2 in x_positions:
-            card = frame[y1+37:y1+149, x1:x2]
-            # Detects selected cards, which are bigger, and resizes them.
-            if y1 > 9 and thresh[y1-10:y1-5, x1:x2].mean() < 100:
-                card = frame[y1+22:y1+152, x1-9:x2+9]
-                card = cv2.resize(card, (112, 112))
-            row.append(card)
-        yield row
-
-
-def _is_duplicate_cards(all_cards: List[numpy.ndarray], new_cards: List[numpy.ndarray]) -> bool:
+    return numpy.array(y_positions, dtype=numpy.int32)
+
+
+if numba is not None:
+    # Fused version of the above: one typed pass over the mask with no
+    # intermediate arrays. Compiled once and cached on disk.
+    @numba.njit(cache=True)
+    def _find_y_positions(thresh: numpy.ndarray) -> numpy.ndarray:  # noqa: F811
+        height, width = thresh.shape
+        separators = numpy.empty(height, numpy.int32)
+        count = 0
+        prev_hot = False
+        for y in range(height):
+            total = 0
+            for x in range(width):
+                total += thresh[y, x]
+            hot = total > 190 * width  # Same as mean(axis=1) > 190.
+            if y > 0 and hot != prev_hot:
+                separators[count] = y - 1
+                count += 1
+            prev_hot = hot
+
+        y_positions = numpy.empty(count + 1, numpy.int32)
+        found = 0
+        for i in range(count - 1):
+            if not (180 < separators[i + 1] - separators[i] < 200):
+                continue  # Invalid card size
+            y_positions[found] = separators[i]
+            found += 1
+
+        # Then, if the last row is missing, we predict its value.
+        if found and y_positions[found - 1] < 100:
+            y_positions[found] = y_positions[found - 1] + 211
+            found += 1
+        return y_positions[:found]
+
+    # Warm the compilation cache so the first frame isn't penalized.
+    _find_y_positions(numpy.zeros((2, 2), numpy.uint8))
+
+
+# Reusable row buffers for the duplicate checks below, so the per-frame
+# dedup path doesn't allocate fresh row-sized arrays on every call.
+_NEW_ROW_BUF: Optional[numpy.ndarray] = None
+_OLD_ROW_BUF: Optional[numpy.ndarray] = None
+
+
+def _hconcat_into(imgs: List[numpy.ndarray],
+                  buf: Optional[numpy.ndarray]) -> numpy.ndarray:
+    """Concatenates images horizontally into a reusable buffer."""
+    height, width = imgs[0].shape[:2]
+    shape = (height, width * len(imgs), 3)
+    if buf is None or buf.shape != shape:
+        buf = numpy.empty(shape, numpy.uint8)
+    for i, img in enumerate(imgs):
+        buf[:, i * width:(i + 1) * width] = img
+    return buf
+
+
+def _normalize_cards(cards: List[numpy.ndarray]) -> List[numpy.ndarray]:
+    """Resizes selected (bigger) cards down to the regular card size."""
+    return [card if card.shape[:2] == (112, 112) else
+            cv2.resize(card, (112, 112)) for card in cards]
+
+
+def _row_hash(row_imgs: List[numpy.ndarray]) -> int:
+    """Computes a 72-bit difference hash for a row of card images."""
+    # Each card is shrunk individually so rows containing the larger
+    # selected-card crop hash the same way as regular rows.
+    tiny = cv2.hconcat([cv2.resize(img, (2, 8)) for img in row_imgs])
+    gray = cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY)
+    bits = (gray[:, 1:] > gray[:, :-1]).astype(numpy.uint8)
+    return int.from_bytes(numpy.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def _is_duplicate_cards(all_cards: List[numpy.ndarray], row_hashes: List[int],
+                        new_cards: List[numpy.ndarray], new_hash: int) -> bool:
     """Checks if the new set of cards are the same as the previous seen cards."""
+    global _NEW_ROW_BUF, _OLD_ROW_BUF
     if not new_cards or len(all_cards) < len(new_cards):
         return False
 
-    new_concat = cv2.hconcat(new_cards)
     # Checks the last 3 rows for similarities to the newly added row.
-    for ind in [slice(-5, None), slice(-10, -5), slice(-15, -10)]:
-        old_concat = cv2.hconcat(all_cards[ind])
-        if old_concat is None:
+    for offset, ind in [(-1, slice(-5, None)), (-2, slice(-10, -5)),
+                        (-3, slice(-15, -10))]:
+        if len(row_hashes) < -offset:
             continue
-        if cv2.absdiff(new_concat, old_concat).mean() < 10:
+        distance = bin(new_hash ^ row_hashes[offset]).count('1')
+        if distance < 10:
+            return True  # Hashes agree; clearly the same row.
+        if distance >= 20:
+            continue  # Hashes clearly differ; skip the image comparison.
+
+        # Marginal hash distance; fall back to the full image comparison.
+        _NEW_ROW_BUF = _hconcat_into(_normalize_cards(new_cards), _NEW_ROW_BUF)
+        _OLD_ROW_BUF = _hconcat_into(all_cards[ind], _OLD_ROW_BUF)
+        if _mean_absdiff(_NEW_ROW_BUF, _OLD_ROW_BUF) < 10:
             return True
     return False
 
 
+def _mean_absdiff(img1: numpy.ndarray, img2: numpy.ndarray) -> float:
+    """Computes the mean absolute difference, on the GPU when available."""
+    if HAVE_OPENCL:
+        # Only per-channel scalars come back from the device.
+        diff = cv2.absdiff(cv2.UMat(img1), cv2.UMat(img2))
+        return sum(cv2.mean(diff)[:3]) / 3
+    return cv2.absdiff(img1, img2).mean()
+
+
 @functools.lru_cache()
 def _get_recipe_db() -> Dict[str, List[RecipeCard]]:
     """Fetches the item database for a given locale, with caching."""
     with open(os.path.join('recipes', 'names.json')) as fp:
         recipes_data = json.load(fp)
 
-    recipe_db = collections.defaultdict(list)
+    item_names = collections.defaultdict(list)
     for item_name, _, card_type in recipes_data:
-        recipe = RecipeCard(item_name, card_type)
-        recipe_db[card_type].append(recipe)
+        item_names[card_type].append(item_name)
+
+    recipe_db = collections.defaultdict(list)
+    for card_type, names in item_names.items():
+        stack = _load_card_stack(card_type, names)
+        recipe_db[card_type] = [
+            RecipeCard(name, card_type, img) for name, img in zip(names, stack)]
 
     # Merge orange, pink and yellow since they are often mixed up.
     merged = recipe_db['orange'] + recipe_db['pink'] + recipe_db['yellow']
@@ -188,37 +305,109 @@ def _get_recipe_db() -> Dict[str, List[RecipeCard]]:
     return recipe_db
 
 
+def _load_card_stack(card_type: str, item_names: List[str]) -> numpy.ndarray:
+    """Loads a card type's recipe images, consolidated in one on-disk array.
+
+    The first run decodes the individual PNGs and writes one .npy file per
+    card type next to them; later runs memory-map these files instead of
+    paying for hundreds of PNG decodes on startup.
+    """
+    generated_dir = os.path.join('recipes', 'generated')
+    cache_name = '_cache_%s.npy' % card_type.replace(' ', '_')
+    cache_path = os.path.join(generated_dir, cache_name)
+    index_path = os.path.join(generated_dir, '_cache_index.json')
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as fp:
+            index = json.load(fp)
+
+    if index.get(card_type) != item_names or not os.path.exists(cache_path):
+        # Cache is missing or stale; rebuild it from the original images.
+        stack = numpy.stack([
+            cv2.imread(os.path.join(generated_dir, name + '.png'))
+            for name in item_names])
+        numpy.save(cache_path, stack)
+        index[card_type] = item_names
+        with open(index_path, 'w') as fp:
+            json.dump(index, fp)
+
+    return numpy.load(cache_path, mmap_mode='r')
+
+
 def _guess_card_type(card: numpy.ndarray) -> str:
     """Guessed the recipe type by the card's background color."""
     # Cut a small piece from the corner and calculate the average color.
     bg_color = card[106:, 60:70, :].mean(axis=(0, 1))
 
-    # Find the closest match in the list of known card types.
-    distance_func = lambda x: numpy.linalg.norm(numpy.array(x) - bg_color)
-    best_match = min(CARD_TYPES.keys(), key=distance_func)
-    return CARD_TYPES[best_match]
+    # Find the closest match in the list of known card types with a
+    # single vectorized squared-distance computation.
+    distances = ((CARD_TYPE_COLORS - bg_color) ** 2).sum(axis=1)
+    return CARD_TYPE_NAMES[distances.argmin()]
+
+
+@functools.lru_cache()
+def _get_recipe_stack(card_type: str) -> numpy.ndarray:
+    """Stacks a card type's recipe images into one contiguous array, with caching."""
+    recipes = _get_recipe_db()[card_type]
+    return numpy.stack([r.img for r in recipes]).astype(numpy.int16)
+
+
+@functools.lru_cache()
+def _get_thumb_stack(card_type: str) -> numpy.ndarray:
+    """Stacks 32x32 thumbnails of a card type's recipes, with caching."""
+    recipes = _get_recipe_db()[card_type]
+    return numpy.stack([
+        cv2.resize(numpy.ascontiguousarray(r.img), (32, 32))
+        for r in recipes]).astype(numpy.int16)
 
 
-def _find_best_match(card: numpy.ndarray, recipes: List[RecipeCard]) -> RecipeCard:
+def _find_best_match(card: numpy.ndarray, card_type: str) -> RecipeCard:
     """Finds the closest matching recipe for the given card."""
-    fast_similarity_metric = lambda r: cv2.absdiff(card, r.img).mean()
-    similarities = list(map(fast_similarity_metric, recipes))
+    recipes = _get_recipe_db()[card_type]
+    stack = _get_recipe_stack(card_type)
+
+    # First pass on 32x32 thumbnails to narrow the bucket down to the top
+    # few candidates; this touches ~12x less memory than full resolution.
+    thumb = cv2.resize(card, (32, 32),
+                       interpolation=cv2.INTER_AREA).astype(numpy.int16)
+    card = card.astype(numpy.int16)
+    thumb_similarities = numpy.abs(
+        _get_thumb_stack(card_type) - thumb).mean(axis=(1, 2, 3))
+    if len(recipes) > 5:
+        candidates = numpy.argpartition(thumb_similarities, kth=5)[:5]
+    else:
+        candidates = numpy.arange(len(recipes))
+
+    # Second pass at full resolution over the top candidates only.
+    subset = stack[candidates]
+    similarities = numpy.abs(subset - card).mean(axis=(1, 2, 3))
     sim1, sim2 = numpy.partition(similarities, kth=2)[:2]
 
     # If the match seems obvious, return the quick result.
     if abs(sim1 - sim2) > 3:
-        return recipes[numpy.argmin(similarities)]
+        return recipes[candidates[similarities.argmin()]]
 
     # Otherwise, we use a slower matching, which tries various shifts.
-    def slow_similarity_metric(recipe):
-        diffs = []
-        for y in [-1, 0, 1]:
-            shifted = numpy.roll(card, y, axis=0)
-            diffs.append(cv2.absdiff(shifted, recipe.img).sum())
-        return min(diffs)  # Return lowest diff across shifts.
-
-    similarities = list(map(slow_similarity_metric, recipes))
-    return recipes[numpy.argmin(similarities)]
+    similarities = _shifted_similarities(card, subset)
+    return recipes[candidates[similarities.argmin()]]
+
+
+def _shifted_similarities(card: numpy.ndarray, stack: numpy.ndarray) -> numpy.ndarray:
+    """Computes summed absdiffs across small vertical shifts of the card.
+
+    Shifts are expressed as overlapping slices instead of numpy.roll,
+    which would allocate a full copy of the card per shift per call.
+    """
+    height = card.shape[0]
+    similarities = []
+    for y in [-1, 0, 1]:
+        if y >= 0:
+            shifted, reference = card[:height - y], stack[:, y:]
+        else:
+            shifted, reference = card[-y:], stack[:, :y]
+        similarities.append(numpy.abs(shifted - reference).sum(axis=(1, 2, 3)))
+    return numpy.minimum.reduce(similarities)  # Lowest diff across shifts.
 
 
 if __name__ == "__main__":
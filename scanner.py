@@ -1,4 +1,4 @@
-from common import ScanResult
+from common import ScanResult, decode_frames
 from typing import Any, Dict
 
 import catalog
@@ -21,6 +21,20 @@ SCANNERS: Dict[str, Any] = {
     'recipes': recipes,
 }
 
+# Cheap screening regions for media type detection: mode, ROI slices,
+# expected background color and squared distance threshold. These mirror
+# each scanner's detect() region; the scanner's own detect() is only
+# called to confirm once a screen matches.
+_DETECTION_SCREENS = [
+    ('catalog', (slice(140, 150), slice(-20, None)), catalog.BG_COLOR, 36),
+    ('critters', (slice(None, 20), slice(1100, 1150)), critters.BG_COLOR, 25),
+    ('music', (slice(None, 20), slice(1220, 1250)), music.BG_COLOR, 100),
+    ('reactions', (slice(370, 380), slice(290, 300)), reactions.BG_COLOR, 25),
+    ('recipes', (slice(None, 20), slice(1200, 1250)), recipes.BG_COLOR, 25),
+    # Matches workbenches so recipes.detect() can reject them explicitly.
+    ('recipes', (slice(None, 20), slice(1200, 1250)), recipes.WOOD_COLOR, 25),
+]
+
 FLAGS = flags.FLAGS
 flags.DEFINE_enum('locale', 'auto', catalog.LOCALE_MAP.keys(),
                   'The locale to use for parsing item names.')
@@ -47,12 +61,10 @@ def scan_media(filename: str, mode: str = 'auto', locale: str = 'auto', for_sale
 
 
 def _detect_media_type(filename: str) -> str:
-    video_capture = cv2.VideoCapture(filename)
-
-    # Check the first ~3s of the video.
-    for _ in range(100):
-        success, frame = video_capture.read()
-        if not success or frame is None:
+    # Check every 5th frame over the first ~3s of the video; the UI stays
+    # on screen for seconds at a time, so sparse sampling is safe.
+    for i, frame in enumerate(decode_frames(filename, step=5)):
+        if i >= 20:
             break
 
         # Resize 1080p screenshots to 720p to match videos.
@@ -62,8 +74,11 @@ def _detect_media_type(filename: str) -> str:
         assert frame.shape[:2] == (720, 1280), \
             'Invalid resolution: {1}x{0}'.format(*frame.shape)
 
-        for mode, scanner in SCANNERS.items():
-            if scanner.detect(frame):
+        for mode, (roi_y, roi_x), color, threshold in _DETECTION_SCREENS:
+            mean = frame[roi_y, roi_x].mean(axis=(0, 1))
+            if sum((m - c) ** 2 for m, c in zip(mean, color)) >= threshold:
+                continue  # Screen rejected; skip the full detection.
+            if SCANNERS[mode].detect(frame):
                 return mode
 
     raise AssertionError('Video is not showing a known scan type.')